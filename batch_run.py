@@ -0,0 +1,37 @@
+from multiprocessing import Pool
+
+from model import NaSchTraffic
+
+
+def run_one(seed_and_params):
+    """
+    Run a single model and return its per-step averages.
+    Args:
+        seed_and_params: Tuple of (seed, params, max_steps) where params is a dict of model parameters.
+    Returns:
+        Dict of the model's per-step speed_averages, happiness_averages, densities, flows and lighting_averages.
+    """
+    seed, params, max_steps = seed_and_params
+    model = NaSchTraffic(**params, collect_data=False, seed=seed).run(max_steps)
+    return {
+        "speed_averages": model.speed_averages,
+        "happiness_averages": model.happiness_averages,
+        "densities": model.densities,
+        "flows": model.flows,
+        "lighting_averages": model.lighting_averages,
+    }
+
+
+def batch_run(params, seeds, max_steps, processes=None):
+    """
+    Run independent models in parallel, one per seed, all with the same parameters.
+    Args:
+        params: Dict of model parameters, e.g. {"width": 200, "vehicle_density": 0.1}.
+        seeds: Seed for each run.
+        max_steps: Number of steps to run each model for.
+        processes: Number of worker processes, defaults to the number of CPUs.
+    Returns:
+        List of run_one results, in the same order as seeds.
+    """
+    with Pool(processes) as pool:
+        return pool.map(run_one, [(seed, params, max_steps) for seed in seeds])
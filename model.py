@@ -1,161 +1,44 @@
 from mesa import Model, Agent
-from mesa.time import SimultaneousActivation
+from mesa.time import BaseScheduler
 from mesa.space import SingleGrid
 from mesa.datacollection import DataCollector
-from collections import deque
 from math import floor
+import numpy as np
+
+from nasch_step import DESIRED_VISIBILITIES, step_vehicles
+
+# Street light level, indexed by the last 3 bits of its history (bit 0 is the current step). A vehicle sensed now
+# gives 80, otherwise one sensed 1 step ago gives 50, otherwise one sensed 2 steps ago gives 35, otherwise 20.
+LIGHTING_LEVELS = np.array([20, 80, 50, 80, 35, 80, 50, 80], dtype=np.uint8)
 
 
 class VehicleAgent(Agent):
     """
-    Vehicle agent
+    Vehicle agent. The vehicle state is held in arrays on the model, so the agent is a view of one vehicle used to
+    place it on the grid for visualisation.
     """
 
-    def __init__(self, pos, model, max_speed):
+    def __init__(self, idx, model):
         """
         Create a new vehicle agent.
         Args:
-           pos: Agent initial position in x, y.
+           idx: Index of the vehicle in the model's vehicle arrays.
            model: The model the agent is associated with.
-           max_speed: The maximum number of cells an agent can move in a single step
-        """
-        super().__init__(pos, model)
-        self.pos = pos
-        self.speed = 0
-        self.max_speed = max_speed
-        self._next_pos = None
-        self.happy = 0
-
-    def step(self):
-        """
-        Calculates the next position of the agent based on several factors:
-        - Current Speed
-        - Max Speed
-        - Proximity of agent ahead of it
-        - Random chance of deceleration
-        """
-        # STEP 0: LOGGING
-        if self.model.debug == 1 or self.model.debug == 3:
-            log_entry = (self.pos[0], self.model.schedule.steps, self.speed)
-            self.model.agent_position_log.append(log_entry)
-
-        # STEP 1: ACCELERATION
-        if self.speed < self.max_speed:
-            self.speed += 1
-
-        # STEP 2: DECELERATION
-        distance_to_next = 0
-        (x, y) = self.pos
-        for distance in range(self.max_speed):
-            distance += 1
-            test_x = x + distance
-            test_pos = self.model.grid.torus_adj((test_x, y))
-            if self.model.grid.is_cell_empty(test_pos): #and self.model.lighting_grid[test_pos[0]] > 50: #this needs lighting sensors implemented to work
-                distance_to_next += 1
-                if distance_to_next == self.speed:
-                    break
-            else:
-                break
-        self.speed = distance_to_next
-
-        # STEP 3: RANDOMISATION
-        if self.random.random() < self.model.p_randomisation and self.speed > 0:
-            self.speed -= 1
-
-        # HAPPINESS
-        desired_visibilities = [3, 3, 3, 6, 9, 13, 18, 24]
-        visibility = desired_visibilities[self.speed]
-        (x, y) = self.pos
-        loc_lighting = 0
-        max_x = len(self.model.lighting_grid)
-        for dx in range(-2, visibility+1):
-            test_x = x + dx
-            if test_x >= max_x:
-                test_x = test_x - max_x
-            elif test_x < 0:
-                test_x = max_x + test_x     # test_x is negative so add rather than subtract
-            loc_lighting += self.model.lighting_grid[test_x]
-        loc_happy = (loc_lighting/(visibility+3))/70
-        if loc_happy > 1:
-            self.happy = 1
-        else:
-            self.happy = loc_happy
-
-        # STEP 4: MOVEMENT
-        self._next_pos = self.pos
-        (x, y) = self._next_pos
-        x_next = x + self.speed
-        self._next_pos = self.model.grid.torus_adj((x_next, y))
-
-        # DATA COLLECTION
-        if 0.2*self.model.width <= x < 0.8*self.model.width:         # agent inside measurement range
-            self.model.total_happy += self.happy
-            self.model.total_speed = self.model.total_speed + self.speed
-            self.model.total_vehicles += 1
-            if x_next >= 0.8*self.model.width:           # agent leaving measurement range
-                self.model.total_flow += 1
-
-    def advance(self):
         """
-        Moves the agent to its next position.
-        """
-        self.model.grid.move_agent(self, self._next_pos)
-
-
-class StreetLightAgent(Agent):
-    """
-    Street light agent
-    """
+        super().__init__(idx, model)
+        self.idx = idx
 
-    def __init__(self, pos, model, light_range):
-        """
-        Create a new street light agent.
-        Args:
-           pos: Agent initial position in x, y.
-           model: The model the agent is associated with.
-           light_range: The maximum number of cells the street light can sense/light up
-        """
-        super().__init__(10000 + pos[0], model)
-        self.pos = pos
-        self.light_range = light_range
-        self.lit_state = False
-        self.historic_lit_state = deque([False, False, False, False, False], maxlen=5)
+    @property
+    def max_speed(self):
+        return self.model.veh_max_speed[self.idx]
 
-    def step(self):
-        """
-        Calculates the next next lit_state of the agent based on several factors:
-        - Agents currently in sensed area
-        - Neighboring lights currently lit
-        - Historic lit_state
-        """
-        temp_lit_state = False
-        (x, y) = self.pos
-        for dx in range(0, self.light_range):
-            if not self.model.grid.is_cell_empty((x+dx, y)):
-                temp_lit_state = True
-                break
-        self.historic_lit_state.appendleft(temp_lit_state)
-
-    def advance(self):
-        """
-        Changes the agent lit_state to its next state.
-        """
-        if self.historic_lit_state[0]:
-            self.lit_state = True
-            lighting_level = 80
-        elif self.historic_lit_state[1]:
-            self.lit_state = True
-            lighting_level = 50
-        elif self.historic_lit_state[2]:
-            self.lit_state = True
-            lighting_level = 35
-        else:
-            lighting_level = 20
+    @property
+    def speed(self):
+        return self.model.veh_speed[self.idx]
 
-        (x, y) = self.pos
-        for dx in range(0, self.light_range):
-            self.model.lighting_grid[x + dx] = lighting_level
-        # print("Street Light at " + str(self.pos[0]) + " is lit? " + str(self.historic_lit_state))
+    @property
+    def happy(self):
+        return self.model.veh_happy[self.idx]
 
 
 class NaSchTraffic(Model):
@@ -171,9 +54,14 @@ class NaSchTraffic(Model):
                  general_max_speed=5,
                  p_randomisation=0.4,
                  debug=0,
-                 seed=None):
+                 seed=None,
+                 collect_data=True):
         """"""
 
+        # Speeds index DESIRED_VISIBILITIES in the compiled kernel, which does not check bounds
+        if not 0 <= general_max_speed < len(DESIRED_VISIBILITIES):
+            raise ValueError("general_max_speed must be between 0 and " + str(len(DESIRED_VISIBILITIES) - 1))
+
         super().__init__(seed=seed)
         self.height = height
         self.width = width
@@ -181,13 +69,19 @@ class NaSchTraffic(Model):
         self.general_max_speed = general_max_speed
         self.p_randomisation = p_randomisation
         self.debug = debug
-        self.schedule = SimultaneousActivation(self)
-        self.grid = SingleGrid(width, height, torus=True)
+        self.collect_data = collect_data    # False skips the DataCollector, e.g. for batch runs
+        self.rng = np.random.default_rng(seed)
+        # Agents are updated as arrays in step(), so the schedule has no agents and only counts steps
+        self.schedule = BaseScheduler(self)
+        self._grid = None    # built on first access, see the grid property
+        self._grid_synced = False
+        self.occupancy = np.zeros(width, dtype=np.bool_)
         self.light_range = int(floor(36 / 4.5))
-        self.lighting_grid = [20] * width
-        self.agent_position_log = []
+        self.lighting_grid = np.full(width, 20, dtype=np.uint8)
+        self._meas_lo = int(width*0.2)    # cells of lighting_grid inside the measurement range
+        self._meas_hi = int(width*0.8)
+        self.agent_position_log = np.empty((0, 3), dtype=np.int32)    # rows of (x, step, speed)
 
-        self.total_street_lights = 0
         self.total_speed = 0
         self.total_happy = 0
         self.total_vehicles = 0
@@ -198,13 +92,14 @@ class NaSchTraffic(Model):
         self.current_density = 0.0
         self.average_lighting_level = 0.0
 
-        self.speed_averages = []
-        self.happiness_averages = []
-        self.densities = []
-        self.flows = []
-        self.lighting_averages = []
+        # Per-step history of speed_averages, happiness_averages, densities, flows and lighting_averages,
+        # preallocated and doubled in size when full
+        self._history = np.zeros((5, 1024), dtype=np.float32)
+        self._history_len = 0
 
-        if self.debug == 1 or self.debug == 3:
+        if not self.collect_data:
+            self.datacollector = None
+        elif self.debug == 1 or self.debug == 3:
             self.datacollector = DataCollector(
                 model_reporters={
                     "Average_Speed": "average_speed",  # Model-level count of average speed of all agents
@@ -232,48 +127,48 @@ class NaSchTraffic(Model):
             )
 
         # Set up agents
-        # Street lights first as these are fixed
-        y = 0
-        for light_iter in range(0, int(width / self.light_range)):
-            x = light_iter * self.light_range
-            agent = StreetLightAgent((x, y), self, self.light_range)
-            self.schedule.add(agent)
-            self.total_street_lights += 1
+        # Street lights first as these are fixed. Light k senses and lights up the light_range cells starting at cell
+        # k*light_range, and remembers whether it sensed a vehicle in each of the last 5 steps as a bitmask (bit 0 is
+        # the latest).
+        self.total_street_lights = int(width / self.light_range)
+        self.light_hist = np.zeros(self.total_street_lights, dtype=np.uint8)
+        self.light_levels = np.full(self.total_street_lights, 20, dtype=np.uint8)
 
         if self.debug > 1:
             print("Added " + str(self.total_street_lights) + " lights")
 
-        # We use a grid iterator that returns
-        # the coordinates of a cell as well as
-        # its contents. (coord_iter)
-        cells = list(self.grid.coord_iter())
-        self.random.shuffle(cells)
+        # Vehicles are stored as arrays in road order, placed in distinct random cells. They start sorted by position,
+        # but once one wraps around the road only the cyclic order holds: vehicle i+1 is ahead of vehicle i, and
+        # vehicle 0 is ahead of the last vehicle
         vehicle_quantity = int(width*self.vehicle_density)
-        for vehicle_iter in range(0, vehicle_quantity):
-            cell = cells[vehicle_iter]
-            (content, x, y) = cell
-            agent = VehicleAgent((x, y), self, general_max_speed)
-            self.grid.position_agent(agent, (x, y))
-            self.schedule.add(agent)
+        self.num_vehicles = vehicle_quantity
+        self.veh_x = np.sort(self.rng.choice(width, size=vehicle_quantity, replace=False)).astype(np.int32)
+        # general_max_speed is checked above to index DESIRED_VISIBILITIES, so speeds always fit in int8
+        self.veh_speed = np.zeros(vehicle_quantity, dtype=np.int8)
+        self.veh_max_speed = np.full(vehicle_quantity, general_max_speed, dtype=np.int8)
+        self.veh_happy = np.zeros(vehicle_quantity, dtype=np.float32)
+        self.occupancy[self.veh_x] = True
 
         if self.debug > 1:
             print("Added " + str(vehicle_quantity) + " vehicles")
 
         self.running = True
-        self.datacollector.collect(self)
+        if self.collect_data:
+            self.datacollector.collect(self)
 
     def step(self):
         """
         Run one step of the model. Calculate current average speed of all agents.
         """
 
-        self.total_speed = 0
-        self.total_happy = 0
-        self.total_vehicles = 0
-        self.total_flow = 0
-        self.agent_position_log = []
-        # Step all agents, then advance all agents
-        self.schedule.step()
+        # Street lights sense the vehicles, vehicles move seeing the previous lighting, then street lights update
+        self._lights_step()
+        self._vehicles_step()
+        self._lights_advance()
+        self._grid_synced = False
+        # The schedule has no agents to step, so only advance its counters
+        self.schedule.steps += 1
+        self.schedule.time += 1
         if self.total_vehicles > 0:
             self.average_speed = self.total_speed / self.total_vehicles
             self.average_happy = self.total_happy / self.total_vehicles
@@ -283,14 +178,163 @@ class NaSchTraffic(Model):
             self.average_happy = 0
             self.current_density = 0
 
-        lighting_subset = self.lighting_grid[int(self.width*0.2):int(self.width*0.8)]
-        self.average_lighting_level = sum(lighting_subset) / len(lighting_subset)
+        self.average_lighting_level = float(self.lighting_grid[self._meas_lo:self._meas_hi].mean(dtype=np.float64))
 
-        self.speed_averages.append(self.average_speed)
-        # self.happiness_averages.append(self.average_happy)
-        self.densities.append(self.current_density)
-        self.flows.append(float(self.total_flow))
-        # self.lighting_averages.append(self.average_lighting_level)
+        if self._history_len == self._history.shape[1]:
+            self._history = np.concatenate((self._history, np.zeros_like(self._history)), axis=1)
+        self._history[:, self._history_len] = (self.average_speed, self.average_happy, self.current_density,
+                                               self.total_flow, self.average_lighting_level)
+        self._history_len += 1
 
         # collect data
-        self.datacollector.collect(self)
+        if self.collect_data:
+            self.datacollector.collect(self)
+
+    @property
+    def grid(self):
+        """
+        Grid with a vehicle agent at every vehicle's position. Only the visualisation needs it, so it and the agents
+        are created on first access and headless runs never build them. Agents are moved to their vehicles' positions
+        when the grid is read, rather than every step.
+        """
+        self._update_grid()
+        return self._grid
+
+    @property
+    def vehicles(self):
+        """
+        Vehicle agents placed on the grid, built with it on first access.
+        """
+        self._update_grid()
+        return self._vehicles
+
+    @property
+    def speed_averages(self):
+        """
+        Snapshot copy of the average speed at each step so far.
+        """
+        return self._history[0, :self._history_len].copy()
+
+    @property
+    def happiness_averages(self):
+        """
+        Snapshot copy of the average happiness at each step so far.
+        """
+        return self._history[1, :self._history_len].copy()
+
+    @property
+    def densities(self):
+        """
+        Snapshot copy of the density at each step so far.
+        """
+        return self._history[2, :self._history_len].copy()
+
+    @property
+    def flows(self):
+        """
+        Snapshot copy of the flow at each step so far.
+        """
+        return self._history[3, :self._history_len].copy()
+
+    @property
+    def lighting_averages(self):
+        """
+        Snapshot copy of the average lighting level at each step so far.
+        """
+        return self._history[4, :self._history_len].copy()
+
+    def run(self, n_steps):
+        """
+        Run the model for n_steps steps, or until it stops running, without the overhead of a BatchRunner.
+        Returns the model so that a reporter can be read straight from the call, e.g.
+        NaSchTraffic(seed=1).run(800).speed_averages
+        """
+        end_step = self.schedule.steps + n_steps
+        while self.running and self.schedule.steps < end_step:
+            self.step()
+        return self
+
+    def _lights_step(self):
+        """
+        Calculates the next lit state of every street light based on several factors:
+        - Vehicles currently in sensed area
+        - Historic lit state
+        """
+        # Lights are evenly spaced, so each row of this view is one light's sensed cells
+        n_lights = self.total_street_lights
+        sensed = self.occupancy[:n_lights*self.light_range].reshape(n_lights, self.light_range).any(axis=1)
+        self.light_hist = ((self.light_hist << 1) | sensed) & 0x1F
+
+    def _lights_advance(self):
+        """
+        Changes the lighting level of every street light to its next state.
+        """
+        self.light_levels = LIGHTING_LEVELS[self.light_hist & 7]
+        # As when sensing, each row of this view is one light's cells
+        n_lights = self.total_street_lights
+        lit_cells = self.lighting_grid[:n_lights*self.light_range].reshape(n_lights, self.light_range)
+        lit_cells[:] = self.light_levels[:, None]
+
+    def _vehicles_step(self):
+        """
+        Calculates the next speed of every vehicle and moves it, in one compiled pass, based on several factors:
+        - Current Speed
+        - Max Speed
+        - Proximity of vehicle ahead of it
+        - Random chance of deceleration
+        """
+        x = self.veh_x
+
+        # STEP 0: LOGGING
+        # A new array every step, as the data collector keeps a reference to each one
+        if self.debug == 1 or self.debug == 3:
+            log = np.empty((self.num_vehicles, 3), dtype=np.int32)
+            log[:, 0] = x
+            log[:, 1] = self.schedule.steps
+            log[:, 2] = self.veh_speed
+            self.agent_position_log = log
+
+        # STEPS 1-4, HAPPINESS AND DATA COLLECTION
+        rand = self.rng.random(self.num_vehicles, dtype=np.float32)
+        (self.total_speed, self.total_happy,
+         self.total_vehicles, self.total_flow) = step_vehicles(x, self.veh_speed, self.veh_max_speed, self.veh_happy,
+                                                               self.occupancy, rand, self.p_randomisation,
+                                                               self.lighting_grid, self.width,
+                                                               0.2*self.width, 0.8*self.width)
+
+    def _update_grid(self):
+        """
+        Builds the grid on first use, otherwise syncs it if any steps have run since it was last read.
+        """
+        if self._grid is None:
+            self._build_grid()
+        elif not self._grid_synced:
+            self._sync_grid()
+        self._grid_synced = True
+
+    def _build_grid(self):
+        """
+        Creates the grid and places a vehicle agent at every vehicle's position.
+        """
+        self._grid = SingleGrid(self.width, self.height, torus=True)
+        self._grid_pos = [(x, 0) for x in range(self.width)]    # reused position tuples for the grid
+        self._vehicles = []
+        for vehicle_iter, x in enumerate(self.veh_x.tolist()):
+            agent = VehicleAgent(vehicle_iter, self)
+            self._grid.place_agent(agent, self._grid_pos[x])
+            self._vehicles.append(agent)
+
+    def _sync_grid(self):
+        """
+        Moves every vehicle agent to its vehicle's position on the grid.
+        """
+        # After several steps a vehicle may have passed where other vehicles' agents still are, so every moved agent
+        # is removed before any is placed again
+        moved = [(agent, x) for agent, x in zip(self._vehicles, self.veh_x.tolist()) if x != agent.pos[0]]
+        remove_agent = self._grid.remove_agent
+        place_agent = self._grid.place_agent
+        grid_pos = self._grid_pos
+        for agent, _ in moved:
+            remove_agent(agent)
+        for agent, x in moved:
+            place_agent(agent, grid_pos[x])
@@ -0,0 +1,73 @@
+from numba import njit
+import numpy as np
+
+# Distance (in cells) a driver needs to see ahead of them, indexed by speed
+DESIRED_VISIBILITIES = np.array([3, 3, 3, 6, 9, 13, 18, 24], dtype=np.int32)
+
+
+@njit(cache=True)
+def step_vehicles(veh_x, veh_speed, veh_max_speed, veh_happy, occupancy, rand, p_rand, lighting_grid, width,
+                  meas_lo, meas_hi):
+    """
+    Calculates the next speed and happiness of every vehicle and moves it, in a single compiled pass updating
+    veh_x, veh_speed, veh_happy and occupancy in place.
+    Args:
+       veh_x, veh_speed, veh_max_speed, veh_happy: Vehicle state arrays in cyclic road order, i.e. vehicle i+1 is
+           ahead of vehicle i and vehicle 0 is ahead of the last vehicle. veh_x is not sorted once a vehicle wraps.
+       occupancy: Boolean array of vehicle occupancy for every cell on the road.
+       rand: One uniform random number per vehicle for the randomisation step.
+       p_rand: Probability of random deceleration.
+       lighting_grid: Array of lighting levels for every cell on the road.
+       width: Length of the road in cells.
+       meas_lo, meas_hi: Bounds of the measurement range.
+    Returns:
+        (total_speed, total_happy, total_vehicles, total_flow) over the vehicles inside the measurement range.
+    """
+    n = len(veh_x)
+    total_speed = 0
+    total_happy = 0.0
+    total_vehicles = 0
+    total_flow = 0
+    first_x = veh_x[0] if n > 0 else 0    # vehicle 0 moves before the last vehicle, which is following it
+    for i in range(n):
+        x = veh_x[i]
+        next_x = veh_x[i + 1] if i + 1 < n else first_x
+
+        # STEP 1: ACCELERATION
+        speed = min(veh_speed[i] + 1, veh_max_speed[i])
+
+        # STEP 2: DECELERATION
+        # Vehicles never overtake, so the vehicle ahead of vehicle i is always vehicle i+1 (wrapping around the road)
+        # (lighting sensors could also be checked here: lighting_grid[test_x] > 50)
+        speed = min(speed, (next_x - x - 1) % width)
+
+        # STEP 3: RANDOMISATION
+        if rand[i] < p_rand and speed > 0:
+            speed -= 1
+
+        # HAPPINESS
+        visibility = DESIRED_VISIBILITIES[speed]
+        loc_lighting = 0.0
+        for dx in range(-2, visibility + 1):
+            loc_lighting += lighting_grid[(x + dx) % width]
+        happy = min((loc_lighting / (visibility + 3)) / 70, 1.0)
+
+        veh_speed[i] = speed
+        veh_happy[i] = happy
+
+        # DATA COLLECTION
+        if meas_lo <= x < meas_hi:         # vehicle inside measurement range
+            total_happy += happy
+            total_speed += speed
+            total_vehicles += 1
+            if x + speed >= meas_hi:           # vehicle leaving measurement range
+                total_flow += 1
+
+        # STEP 4: MOVEMENT
+        # Every vehicle's speed is limited by the gap to where the vehicle ahead was, so moving each vehicle
+        # straight away gives the same result as moving them all simultaneously
+        occupancy[x] = False
+        veh_x[i] = (x + speed) % width
+        occupancy[veh_x[i]] = True
+
+    return total_speed, total_happy, total_vehicles, total_flow
@@ -24,9 +24,9 @@ class AgentElement(TextElement):
         pass
 
     def render(self, model):
-        text_1 = "Number of agents: " + str(model.schedule.get_agent_count()-model.total_street_lights) + "   "
+        text_1 = "Number of agents: " + str(model.num_vehicles) + "   "
         text_3 = ("Average lighting level at "
-                  + str(int(sum(model.lighting_grid)/(model.light_range*model.total_street_lights)))
+                  + str(int(model.light_levels.mean()))
                   + "%")
         return text_1 + text_3
 
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from model import LIGHTING_LEVELS, NaSchTraffic
+from nasch_step import DESIRED_VISIBILITIES, step_vehicles
+
+
+def simultaneous_step(veh_x, veh_speed, veh_max_speed, rand, p_rand, width):
+    """
+    Reference NaSch update with every vehicle's speed decided before any vehicle moves.
+    """
+    gap = (np.roll(veh_x, -1) - veh_x - 1) % width
+    speed = np.minimum(np.minimum(veh_speed + 1, veh_max_speed), gap)
+    speed = speed - ((rand < p_rand) & (speed > 0))
+    return (veh_x + speed) % width, speed
+
+
+def expected_lighting_level(sensed):
+    """
+    Original street light priority, where sensed[k] is whether the light sensed a vehicle k steps ago.
+    """
+    if sensed[0]:
+        return 80
+    elif sensed[1]:
+        return 50
+    elif sensed[2]:
+        return 35
+    return 20
+
+
+def test_lighting_levels_follow_sensing_priority():
+    for hist in range(32):
+        sensed = [(hist >> k) & 1 for k in range(5)]
+        assert LIGHTING_LEVELS[hist & 7] == expected_lighting_level(sensed)
+
+
+def test_lights_track_sensed_history():
+    rng = np.random.default_rng(0)
+    model = NaSchTraffic(vehicle_density=0, seed=0, collect_data=False)
+    light_range = model.light_range
+    sensed = []
+    for _ in range(100):
+        # Sense a vehicle in a random cell of the first light's range, or none
+        model.occupancy[:] = False
+        if rng.random() < 0.3:
+            model.occupancy[rng.integers(light_range)] = True
+        sensed.insert(0, model.occupancy[:light_range].any())
+        model._lights_step()
+        model._lights_advance()
+        level = expected_lighting_level(sensed + [False, False])
+        assert model.light_levels[0] == level
+        assert (model.lighting_grid[:light_range] == level).all()
+        assert (model.light_levels[1:] == 20).all()
+
+
+def test_vehicles_stay_in_cyclic_order():
+    for seed in range(5):
+        model = NaSchTraffic(width=200, vehicle_density=0.3, seed=seed, collect_data=False)
+        for _ in range(300):
+            model.step()
+            veh_x = model.veh_x
+            # Each vehicle's leader is the next one, so the gaps to the leaders add up to exactly one lap
+            assert ((np.roll(veh_x, -1) - veh_x) % model.width).sum() == model.width
+            assert np.array_equal(np.flatnonzero(model.occupancy), np.sort(veh_x))
+
+
+def test_sequential_moves_match_simultaneous_update():
+    rng = np.random.default_rng(0)
+    width = 200
+    for n in (1, 2, 40, 150, 199):
+        veh_x = np.sort(rng.choice(width, size=n, replace=False)).astype(np.int32)
+        veh_speed = np.zeros(n, dtype=np.int8)
+        veh_max_speed = np.full(n, 5, dtype=np.int8)
+        veh_happy = np.zeros(n, dtype=np.float32)
+        occupancy = np.zeros(width, dtype=np.bool_)
+        occupancy[veh_x] = True
+        lighting_grid = np.full(width, 20, dtype=np.uint8)
+        for _ in range(200):
+            rand = rng.random(n, dtype=np.float32)
+            expected_x, expected_speed = simultaneous_step(veh_x, veh_speed, veh_max_speed, rand, 0.4, width)
+            step_vehicles(veh_x, veh_speed, veh_max_speed, veh_happy, occupancy, rand, 0.4, lighting_grid, width,
+                          0.2*width, 0.8*width)
+            assert np.array_equal(veh_x, expected_x)
+            assert np.array_equal(veh_speed, expected_speed)
+
+
+def test_seeded_runs_are_reproducible():
+    first = NaSchTraffic(width=500, vehicle_density=0.3, seed=7, collect_data=False).run(500)
+    second = NaSchTraffic(width=500, vehicle_density=0.3, seed=7, collect_data=False).run(500)
+    assert np.array_equal(first.veh_x, second.veh_x)
+    assert np.array_equal(first.flows, second.flows)
+    assert np.array_equal(first.speed_averages, second.speed_averages)
+
+
+def test_max_speed_must_index_desired_visibilities():
+    for general_max_speed in (-1, len(DESIRED_VISIBILITIES), 12):
+        with pytest.raises(ValueError):
+            NaSchTraffic(general_max_speed=general_max_speed)
+    model = NaSchTraffic(general_max_speed=len(DESIRED_VISIBILITIES) - 1, p_randomisation=0, seed=1).run(100)
+    assert model.veh_speed.max() == len(DESIRED_VISIBILITIES) - 1